@@ -1,16 +1,38 @@
+from functools import lru_cache
+from pathlib import Path
 from typing import Annotated, TypedDict, AsyncGenerator
+import asyncio
+import hashlib
 import logging
-
-from bs4 import BeautifulSoup
+import operator
+import os
+import queue
+import re
+import threading
+import time
+
+import aiosqlite
+from cachetools import TTLCache
+import chromadb
 from dotenv import load_dotenv, find_dotenv
+import httpx
 from langchain.tools import tool
 from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+    trim_messages,
+)
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
-import requests
+from lxml import etree
+import openai
 
 # ═══════════════════════════════════════════════════════════════════════════
 # LOGGING SETUP
@@ -29,155 +51,221 @@ logger = logging.getLogger(__name__)
 load_dotenv(find_dotenv(), override=True)
 
 MAX_INPUT_LENGTH = 10000
-WEB_SCRAPER_CHAR_LIMIT = 8000
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "checkpoints.db")
+WEB_SCRAPER_CHAR_LIMIT = 4000
 WEB_SCRAPER_TIMEOUT = 20
+WEB_SCRAPER_CHUNK_SIZE = 16384
+WEB_SCRAPER_MAX_BYTES = 512 * 1024
+
+OPENAI_HTTP_TIMEOUT = 60.0
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+HISTORY_MAX_TOKENS = 4096
+HISTORY_MAX_MESSAGES = 40
+PROMPT_CACHE_KEY = "rocky-system-prompt"
+
+SEARCH_CACHE_SIZE = 512
+SEARCH_CACHE_TTL = 3600  # seconds
+SEARCH_RESULT_CHAR_LIMIT = 800
+
+# Elements whose text is page chrome rather than content
+SCRAPER_SKIPPED_TAGS = frozenset(
+    {"script", "style", "nav", "footer", "header", "aside", "iframe"}
+)
+# Elements that end a line of text when they close
+SCRAPER_BLOCK_TAGS = frozenset(
+    {
+        "title", "p", "div", "br", "li", "tr", "td", "th", "pre", "blockquote",
+        "section", "article", "h1", "h2", "h3", "h4", "h5", "h6",
+    }
+)
+SCRAPER_TRUNCATION_NOTE = f"\n\n[Content truncated to {WEB_SCRAPER_CHAR_LIMIT} characters]"
+SCRAPER_BYTE_CAP_NOTE = f"\n\n[Content truncated at {WEB_SCRAPER_MAX_BYTES} bytes of page source]"
+SCRAPER_BYTE_CAP_NO_TEXT = (
+    f"No readable content in the first {WEB_SCRAPER_MAX_BYTES} bytes of the page; "
+    "the download was cut off before any text"
+)
+SCRAPER_TIMEOUT_ERROR = (
+    f"Error: Request timed out after {WEB_SCRAPER_TIMEOUT} seconds for %s"
+)
+# Whitespace normalisation for extracted page text
+SCRAPER_SPACES_RE = re.compile(r"[ \t\r\f\v]+")
+SCRAPER_NEWLINES_RE = re.compile(r"\s*\n\s*")
+
+# Connection pools shared by every OpenAI chat and embeddings request
+openai_http_client = httpx.Client(limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT)
+openai_async_http_client = httpx.AsyncClient(
+    limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT
+)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".semantic_cache")
+SEMANTIC_CACHE_SIMILARITY = float(os.getenv("SEMANTIC_CACHE_SIMILARITY", "0.92"))
+SEMANTIC_CACHE_FLUSH_SIZE = 100
+SEMANTIC_CACHE_FLUSH_INTERVAL = 5.0  # seconds
+SEMANTIC_CACHE_MEMO_SIZE = 1024
+SEMANTIC_CACHE_MEMO_TTL = 3600  # seconds
+SEMANTIC_CACHE_EMBED_RETRIES = 4
+SEMANTIC_CACHE_WORD_RE = re.compile(r"\w+")
 
 # ═══════════════════════════════════════════════════════════════════════════
 # SYSTEM PROMPT
 # ═══════════════════════════════════════════════════════════════════════════
 
-SYSTEM_PROMPT = """
-You are Rocky, an AI assistant specializing in Geology and Earth Sciences.
-
-You have expert-level knowledge across all geological disciplines: petrology, 
-mineralogy, sedimentology, stratigraphy, structural geology, tectonics, geophysics, 
-geomorphology, paleontology, hydrogeology, geochemistry, and applied fields like 
-engineering geology and resource exploration.
-
-Your purpose is to make geological science accessible, accurate, and engaging—
-whether explaining plate tectonics to a curious student or discussing stable 
-isotope geochemistry with a researcher.
-
---------------------
-FORMATTING GUIDELINES
---------------------
-Adapt your response style to the question's complexity and the user's needs:
-
-- For simple questions: Provide direct, conversational answers in natural prose.
-- For complex topics: Use clear paragraphs with structure when it aids understanding.
-- Use lists/bullets when comparing multiple items, listing steps, or when requested.
-- Define technical terms naturally within your explanation.
-- Lead with the most important information.
-- Avoid over-formatting (excessive bold, headers, or lists) in typical explanations.
-
------------------------
-PROVIDING IMAGE RESOURCES
------------------------
-You have a tool called 'find_geological_images' that provides links to trusted geology image sources:
-
-**How to use it:**
-- Use it when visual examples would help (rocks, minerals, diagrams, processes)
-- Be specific in your description: "basalt thin section" not just "rock"
-- The tool automatically picks the best resource (Mindat for minerals, USGS for diagrams, etc.)
-
-**Example usage:**
-- User asks about granite → explain, then mention: "Let me point you to some images of granite"
-- User asks about plate boundaries → explain, then: "I can show you where to find diagrams of this"
-
-**What it provides:**
-- Direct links to professional geology databases
-- High-quality, scientifically accurate images
-- Resources maintained by geologists and institutions
-
------------------------
-SCIENTIFIC APPROACH
------------------------
-- Base answers on established scientific consensus and evidence.
-- Distinguish clearly between established knowledge, leading theories, and speculation.
-- When discussing evolving topics, present multiple perspectives from the literature.
-- Cite the type of evidence supporting claims (e.g., "radiometric dating shows...", 
-  "seismic data indicates...", "field observations suggest...").
-- If information is uncertain or outside your knowledge, say so explicitly.
-- For ambiguous questions, state your assumptions or ask for clarification.
-- If 'tavily_search' is used, ALWAYS cite sources with author/publication when available.
-- Prefer peer-reviewed sources and official geological surveys.
-
--------------------------------
-PROACTIVE ENGAGEMENT & QUESTIONS
--------------------------------
-After answering the user's question, enrich the conversation by:
-
-- Asking 1-2 relevant follow-up questions that deepen understanding of the topic.
-- Connecting to related geological concepts they might find interesting.
-- Exploring the "why" or "how" behind the phenomena discussed.
-- Inquiring about their specific context (e.g., location, academic level, project goals) 
-  when it would help tailor future responses.
-- Suggesting related topics worth exploring based on their interests.
-
-Examples of good follow-up questions:
-- "Are you interested in how this process varies in different tectonic settings?"
-- "Would you like to know how geologists actually measure this in the field?"
-- "Is this for a specific region or project you're working on?"
-- "Have you encountered [related concept] before? It's closely connected to this."
-- "What sparked your interest in this particular aspect of geology?"
-
-**STUDY MODE**: When users want to test their knowledge:
-1. Generate 2-3 questions based on the discussed topic
-2. Wait for their answers
-3. Provide constructive feedback on each answer
-4. Explain correct answers with context
-5. Ask if they want more questions or to move to a new topic
-
-Keep follow-ups natural and conversational—limit to 1-2 questions per response 
-to avoid overwhelming the user.
-
-----------------
-SAFETY GUIDELINES
-----------------
-When discussing topics with safety implications:
-
-- Provide scientific explanations of hazards and processes freely.
-- Explain risk assessment principles and general mitigation strategies.
-- Do NOT provide operational instructions for:
-  * Explosive handling or manufacturing
-  * Unsupervised drilling/excavation operations
-  * Entering hazardous environments (active volcanoes, unstable mines)
-  * Professional fieldwork requiring specialized safety training
-
-- For hazard preparedness: Offer general awareness and direct users to 
-  official emergency management resources.
-- State when professional expertise (licensed geologist, engineer) is required.
-- Educational discussions of hazardous topics for learning purposes are appropriate.
-
---------------------------
-PRACTICAL APPLICATIONS
---------------------------
-When users ask about applied geology:
-
-- Provide educational explanations of methods and principles.
-- Explain what professionals consider in real scenarios.
-- Clarify when questions require site-specific data, professional analysis, 
-  or regulatory compliance.
-- Distinguish between educational explanation and actionable consulting advice.
-
-----------------------
-INTERACTION STYLE
-----------------------
-- Gauge the user's expertise from their question and adjust accordingly.
-- For ambiguous questions, make reasonable assumptions but state them.
-- Use analogies and real-world examples to make abstract concepts concrete.
-- Be enthusiastic—geology is fascinating!
-- If a question falls outside geology, briefly acknowledge and optionally redirect.
-
-Your primary goal is to help users understand Earth science deeply, accurately, 
-and safely—while fostering curiosity through thoughtful questions.
-"""
+SYSTEM_PROMPT = (Path(__file__).parent / "prompts" / "rocky_system.md").read_text(
+    encoding="utf-8"
+)
+
+# Built once; a message (unlike a ("system", ...) tuple) is passed through the
+# prompt template as-is instead of being re-rendered as a template every turn
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
 
 # ═══════════════════════════════════════════════════════════════════════════
 # TOOLS
 # ═══════════════════════════════════════════════════════════════════════════
 
+SCRAPER_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/91.0.4472.124 Safari/537.36"
+)
+
+
+@lru_cache(maxsize=1)
+def get_scraper_client() -> httpx.AsyncClient:
+    """Return the shared scraper client, created lazily inside the running loop."""
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        ),
+        timeout=WEB_SCRAPER_TIMEOUT,
+        follow_redirects=True,
+        headers={"User-Agent": SCRAPER_USER_AGENT},
+    )
+
+
 # Tool 1: Web Search
-tavily_search = TavilySearchResults(
-    max_results=5,
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+search_cache_lock = threading.Lock()
+
+
+class CachedTavilySearch(TavilySearchResults):
+    """Tavily search that reuses results for repeated queries within the TTL."""
+
+    def _cache_key(self, query: str) -> str:
+        normalized = " ".join(query.lower().split())
+        # Options that change the shape of the results are part of the key
+        options = (
+            getattr(self, name, None)
+            for name in (
+                "max_results",
+                "search_depth",
+                "include_answer",
+                "include_raw_content",
+                "include_images",
+                "include_favicon",
+            )
+        )
+        raw_key = "|".join([normalized, *map(str, options)])
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    @staticmethod
+    def _compact(result):
+        """Trim each result's text and drop fields the model does not use."""
+        content = result[0] if isinstance(result, tuple) else result
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict):
+                    item["content"] = (item.get("content") or "")[:SEARCH_RESULT_CHAR_LIMIT]
+                    item.pop("favicon", None)
+                    item.pop("images", None)
+        return result
+
+    @staticmethod
+    def _remember(key: str, result) -> None:
+        # Failed searches come back as an error string; don't cache those
+        content = result[0] if isinstance(result, tuple) else result
+        if isinstance(content, str):
+            return
+        with search_cache_lock:
+            search_cache[key] = result
+
+    def _run(self, query: str, run_manager=None):
+        key = self._cache_key(query)
+        with search_cache_lock:
+            cached = search_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = self._compact(super()._run(query, run_manager=run_manager))
+        self._remember(key, result)
+        return result
+
+    async def _arun(self, query: str, run_manager=None):
+        key = self._cache_key(query)
+        with search_cache_lock:
+            cached = search_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = self._compact(await super()._arun(query, run_manager=run_manager))
+        self._remember(key, result)
+        return result
+
+
+tavily_search = CachedTavilySearch(
+    max_results=3,
     search_depth="advanced",
     include_answer=True,
     include_raw_content=False,
 )
 
 
+async def close_http_clients() -> None:
+    """Close pooled HTTP connections; call once on application shutdown."""
+    if get_scraper_client.cache_info().currsize:
+        await get_scraper_client().aclose()
+        get_scraper_client.cache_clear()
+    await openai_async_http_client.aclose()
+    openai_http_client.close()
+
+
+class PageTextCollector:
+    """lxml parser target that collects visible text while the page streams in."""
+
+    def __init__(self):
+        self.parts: list[str] = []
+        self.length = 0
+        self._skip_depth = 0
+
+    def start(self, tag, attrib):
+        if tag in SCRAPER_SKIPPED_TAGS:
+            self._skip_depth += 1
+
+    def end(self, tag):
+        if tag in SCRAPER_SKIPPED_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in SCRAPER_BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def data(self, data):
+        if self._skip_depth:
+            return
+        if data.isspace():
+            # Indentation between tags; keep a word break but don't count it
+            self.parts.append(" ")
+        else:
+            self.parts.append(data)
+            self.length += len(data)
+
+    def close(self):
+        return "".join(self.parts)
+
+
 @tool
-def web_scraper_tool(url: str) -> str:
+async def web_scraper_tool(url: str) -> str:
     """Scrape a webpage and return cleaned text content."""
     if not url or not isinstance(url, str):
         return "Error: Invalid URL provided"
@@ -187,52 +275,63 @@ def web_scraper_tool(url: str) -> str:
         return f"Invalid URL: {url}. URL must start with http:// or https://"
 
     try:
-        response = requests.get(
-            url,
-            timeout=WEB_SCRAPER_TIMEOUT,
-            headers={
-                "User-Agent": (
-                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                    "AppleWebKit/537.36 (KHTML, like Gecko) "
-                    "Chrome/91.0.4472.124 Safari/537.36"
+        async with get_scraper_client().stream("GET", url) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get("content-type", "").lower()
+            if "text/html" not in content_type and "text/plain" not in content_type:
+                return f"Error: URL returned non-text content type: {content_type}"
+
+            # Parse incrementally and stop downloading once there is enough text
+            collector = PageTextCollector()
+            try:
+                # Honour a charset declared only in the Content-Type header
+                parser = etree.HTMLParser(
+                    target=collector, encoding=response.charset_encoding
                 )
-            },
-            allow_redirects=True,
-        )
-        response.raise_for_status()
-
-        content_type = response.headers.get("content-type", "").lower()
-        if "text/html" not in content_type and "text/plain" not in content_type:
-            return f"Error: URL returned non-text content type: {content_type}"
-
-        soup = BeautifulSoup(response.text, "html.parser")
-        for element in soup(["script", "style", "nav", "footer", "header", "aside", "iframe"]):
-            element.decompose()
-
-        text = soup.get_text(separator="\n", strip=True)
-        lines = [line.strip() for line in text.splitlines() if line.strip()]
-        clean_text = "\n".join(lines)
-
-        if len(clean_text) > WEB_SCRAPER_CHAR_LIMIT:
-            truncated = clean_text[:WEB_SCRAPER_CHAR_LIMIT]
-            return (
-                f"{truncated}\n\n"
-                f"[Content truncated to {WEB_SCRAPER_CHAR_LIMIT} characters. "
-                f"Original length: {len(clean_text)} characters]"
-            )
-
+            except LookupError:
+                # Unknown charset; let lxml detect it from the page itself
+                parser = etree.HTMLParser(target=collector)
+            truncated = False
+            byte_capped = False
+            bytes_read = 0
+            async for chunk in response.aiter_bytes(WEB_SCRAPER_CHUNK_SIZE):
+                parser.feed(chunk)
+                bytes_read += len(chunk)
+                if collector.length >= WEB_SCRAPER_CHAR_LIMIT:
+                    truncated = True
+                    break
+                # Script-heavy pages may never reach the text limit; cap the download too
+                if bytes_read >= WEB_SCRAPER_MAX_BYTES:
+                    byte_capped = True
+                    break
+            try:
+                parser.close()
+            except etree.LxmlError:
+                pass  # Empty or malformed tail; keep the text collected so far
+
+        text = SCRAPER_SPACES_RE.sub(" ", collector.close())
+        clean_text = SCRAPER_NEWLINES_RE.sub("\n", text).strip()
+
+        if truncated or len(clean_text) > WEB_SCRAPER_CHAR_LIMIT:
+            return "".join((clean_text[:WEB_SCRAPER_CHAR_LIMIT], SCRAPER_TRUNCATION_NOTE))
+
+        if byte_capped:
+            if not clean_text:
+                return SCRAPER_BYTE_CAP_NO_TEXT
+            return "".join((clean_text, SCRAPER_BYTE_CAP_NOTE))
         return clean_text if clean_text else "No readable content found on page"
 
-    except requests.Timeout:
-        return f"Error: Request timed out after {WEB_SCRAPER_TIMEOUT} seconds for {url}"
-    except requests.RequestException as exc:
+    except httpx.TimeoutException:
+        return SCRAPER_TIMEOUT_ERROR % url
+    except httpx.HTTPError as exc:
         return f"Error fetching {url}: {str(exc)}"
     except Exception as exc:
         return f"Unexpected error processing {url}: {str(exc)}"
 
 
 @tool
-def find_geological_images(topic: str) -> str:
+async def find_geological_images(topic: str) -> str:
     """
     Find and display geological images from Google Images.
     
@@ -257,7 +356,7 @@ def find_geological_images(topic: str) -> str:
     # Try to get image from Google using Tavily (which can search Google)
     try:
         # Use tavily to search, which will return images from various sources including Google
-        results = tavily_search.invoke({"query": search_query})
+        results = await tavily_search.ainvoke({"query": search_query})
         
         # Try to extract an image URL from results
         image_url = None
@@ -294,85 +393,319 @@ def find_geological_images(topic: str) -> str:
     )
 
 
-@tool
-def start_quiz_mode(topic: str, difficulty: str = "intermediate", num_questions: int = 3) -> str:
-    """
-    Start an interactive geology quiz on a specific topic.
-    
-    Args:
-        topic: The geological topic to quiz on (e.g., "plate tectonics", "igneous rocks")
-        difficulty: Difficulty level - "easy", "intermediate", or "advanced"
-        num_questions: How many questions to generate (1-5)
-    
-    Returns:
-        Instructions for generating quiz questions
-    """
-    # Validate inputs
-    if num_questions < 1:
-        num_questions = 1
-    elif num_questions > 5:
-        num_questions = 5
-    
-    difficulty = difficulty.lower()
-    if difficulty not in ["easy", "intermediate", "advanced"]:
-        difficulty = "intermediate"
-    
-    return (
-        f"🎯 QUIZ MODE ACTIVATED\n\n"
-        f"Generate {num_questions} {difficulty}-level multiple-choice questions about '{topic}'.\n\n"
-        f"Format:\n"
-        f"- Number each question clearly\n"
-        f"- Provide 4 options (A, B, C, D) for each\n"
-        f"- Make questions test understanding, not just memorization\n"
-        f"- After presenting all questions, WAIT for the user to answer\n"
-        f"- Then provide feedback and explanations for each answer\n\n"
-        f"End with: 'Take your time! Reply with your answers (e.g., 1-A, 2-C, 3-B) when ready.'"
-    )
-
-
 # Register all tools
 tools = [
     tavily_search,
     web_scraper_tool,
     find_geological_images,
-    start_quiz_mode,
 ]
 
+# ═══════════════════════════════════════════════════════════════════════════
+# SEMANTIC CACHE
+# ═══════════════════════════════════════════════════════════════════════════
+
+class SemanticLLMCache:
+    """Reuse answers for questions that are paraphrases of ones already answered."""
+
+    def __init__(self, persist_dir: str, similarity: float = 0.92):
+        self.max_distance = 1.0 - similarity
+        self.embeddings = OpenAIEmbeddings(
+            model="text-embedding-3-small",
+            http_client=openai_http_client,
+            http_async_client=openai_async_http_client,
+        )
+        client = chromadb.PersistentClient(path=persist_dir)
+        self.collection = client.get_or_create_collection(
+            name="rocky_responses",
+            metadata={"hnsw:space": "cosine"},
+        )
+
+        # Entries are keyed by a hash of the normalised question, so a question
+        # is stored at most once, across batches and restarts
+        self._stored = set(self.collection.get(include=[])["ids"])
+
+        # Exact repeats skip the embedding API and the vector search entirely
+        self._answers = TTLCache(maxsize=SEMANTIC_CACHE_MEMO_SIZE, ttl=SEMANTIC_CACHE_MEMO_TTL)
+        self._vectors = TTLCache(maxsize=SEMANTIC_CACHE_MEMO_SIZE, ttl=SEMANTIC_CACHE_MEMO_TTL)
+        self._memo_lock = threading.Lock()
+
+        # Writes are queued and added in batches by a background thread
+        self._pending: queue.Queue[tuple[str, str]] = queue.Queue()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="semantic-cache-writer", daemon=True
+        )
+        self._writer.start()
+
+    @staticmethod
+    def _memo_key(question: str) -> str:
+        # Case, whitespace and punctuation differences map to the same key
+        normalized = " ".join(SEMANTIC_CACHE_WORD_RE.findall(question.lower()))
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    async def _embed_query(self, key: str, question: str) -> list[float]:
+        with self._memo_lock:
+            vector = self._vectors.get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(question)
+            with self._memo_lock:
+                self._vectors[key] = vector
+        return vector
+
+    def _nearest_answer(self, vector: list[float]) -> str | None:
+        if self.collection.count() == 0:
+            return None
+
+        result = self.collection.query(
+            query_embeddings=[vector],
+            n_results=1,
+            include=["documents", "distances"],
+        )
+        distances = result["distances"][0]
+        if distances and distances[0] <= self.max_distance:
+            return result["documents"][0][0]
+        return None
+
+    async def lookup(self, question: str) -> str | None:
+        """Return the cached answer closest to `question`, if it is similar enough."""
+        key = self._memo_key(question)
+        with self._memo_lock:
+            if key in self._answers:
+                return self._answers.get(key)
+
+        vector = await self._embed_query(key, question)
+        # Chroma's client is synchronous; keep its local search off the event loop
+        answer = await asyncio.to_thread(self._nearest_answer, vector)
+
+        with self._memo_lock:
+            self._answers[key] = answer
+        return answer
+
+    def store(self, question: str, answer: str) -> None:
+        """Queue `answer` to be remembered as the response to `question`."""
+        key = self._memo_key(question)
+        with self._memo_lock:
+            if key in self._stored:
+                return
+            self._stored.add(key)
+        self._pending.put((question, answer))
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + SEMANTIC_CACHE_FLUSH_INTERVAL
+            while len(batch) < SEMANTIC_CACHE_FLUSH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._flush(batch)
+            except Exception as exc:
+                logger.warning("Semantic cache flush of %d entries failed: %s", len(batch), exc)
+                with self._memo_lock:
+                    self._stored.difference_update(
+                        self._memo_key(question) for question, _ in batch
+                    )
+
+    def _embed_documents(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(SEMANTIC_CACHE_EMBED_RETRIES):
+            try:
+                return self.embeddings.embed_documents(texts)
+            except openai.RateLimitError:
+                if attempt == SEMANTIC_CACHE_EMBED_RETRIES - 1:
+                    raise
+                time.sleep(2**attempt)
+
+    def _flush(self, batch: list[tuple[str, str]]) -> None:
+        questions = [question for question, _ in batch]
+        keys = [self._memo_key(question) for question in questions]
+
+        # Questions were embedded during lookup; only re-embed expired vectors
+        with self._memo_lock:
+            vectors = [self._vectors.get(key) for key in keys]
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self._embed_documents([questions[index] for index in missing])
+            for index, vector in zip(missing, embedded):
+                vectors[index] = vector
+
+        self.collection.upsert(
+            ids=keys,
+            embeddings=vectors,
+            documents=[answer for _, answer in batch],
+            metadatas=[{"question": question} for question in questions],
+        )
+        # New entries can turn remembered misses into hits
+        with self._memo_lock:
+            self._answers.clear()
+
+
+semantic_cache = (
+    SemanticLLMCache(SEMANTIC_CACHE_DIR, similarity=SEMANTIC_CACHE_SIMILARITY)
+    if SEMANTIC_CACHE_ENABLED
+    else None
+)
+
+
+def standalone_question(state: dict) -> str | None:
+    """Return the user's question if this is the thread's opening turn.
+
+    Follow-up turns depend on earlier context, so only opening questions are
+    safe to answer from (or store in) the semantic cache. The turn count is
+    kept in state because trimming can drop earlier user messages.
+    """
+    if state.get("user_turns", 0) != 1:
+        return None
+    # Threads checkpointed before user_turns existed start counting at 1
+    human_messages = [m for m in state["messages"] if isinstance(m, HumanMessage)]
+    if len(human_messages) != 1:
+        return None
+    content = human_messages[0].content
+    return content if isinstance(content, str) else None
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # LANGGRAPH SETUP
 # ═══════════════════════════════════════════════════════════════════════════
 
+def add_messages_bounded(left: list, right: list) -> list:
+    """Merge messages like `add_messages`, keeping only the most recent turns."""
+    merged = add_messages(left, right)
+    if len(merged) <= HISTORY_MAX_MESSAGES:
+        return merged
+
+    # Cut on a user turn so no tool result is kept without its tool call
+    turn_starts = [
+        index for index, message in enumerate(merged) if isinstance(message, HumanMessage)
+    ]
+    if not turn_starts:
+        return merged
+    earliest = len(merged) - HISTORY_MAX_MESSAGES
+    for index in turn_starts[:-1]:
+        if index >= earliest:
+            return merged[index:]
+
+    # Turns longer than the cap are kept whole; the previous turn always
+    # survives so a follow-up question keeps its context
+    if len(turn_starts) > 1:
+        return merged[turn_starts[-2]:]
+    return merged[turn_starts[-1]:]
+
+
 class State(TypedDict):
-    messages: Annotated[list, add_messages]
+    messages: Annotated[list, add_messages_bounded]
+    user_turns: Annotated[int, operator.add]
 
 
 graph_builder = StateGraph(State)
 
-llm = ChatOpenAI(
+chat_model = ChatOpenAI(
     model="gpt-4.1-nano",
     temperature=0.7,
     presence_penalty=0.6,
     frequency_penalty=0.5,
     top_p=0.9,
-).bind_tools(tools=tools)
+    http_async_client=openai_async_http_client,
+)
+# Every thread shares the system prompt and tool prefix, so one cache key
+# routes them to the same OpenAI prompt-cache shard
+llm = chat_model.bind_tools(tools=tools, prompt_cache_key=PROMPT_CACHE_KEY)
+
+# The system prompt is prepended here rather than stored in the thread, so every
+# request starts with the same byte-identical prefix that the provider can serve
+# from its prompt cache. Tool schemas are converted once by bind_tools above.
+prompt = ChatPromptTemplate.from_messages(
+    [SYSTEM_MESSAGE, MessagesPlaceholder("messages")]
+)
+rocky_chain = (prompt | llm).with_config(run_name="rocky")
 
 
-def chatbot(state: State):
+def trim_history(messages: list) -> list:
+    """Keep only the most recent turns that fit in HISTORY_MAX_TOKENS."""
+    trimmed = trim_messages(
+        messages,
+        max_tokens=HISTORY_MAX_TOKENS,
+        strategy="last",
+        token_counter=chat_model,
+        start_on="human",
+    )
+    if trimmed:
+        return trimmed
+
+    # The current turn alone is over budget (e.g. large tool results); keep it whole
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], HumanMessage):
+            return messages[index:]
+    return messages
+
+
+async def chatbot(state: State):
     """Main chatbot node."""
+    messages = state["messages"]
+    question = standalone_question(state) if semantic_cache else None
+
+    if question is not None and isinstance(messages[-1], HumanMessage):
+        try:
+            cached = await semantic_cache.lookup(question)
+        except Exception as exc:
+            logger.warning("Semantic cache lookup failed: %s", exc)
+            cached = None
+        if cached is not None:
+            logger.info("Semantic cache hit")
+            return {
+                "messages": [
+                    AIMessage(content=cached, response_metadata={"semantic_cache": True})
+                ]
+            }
+
     try:
-        response = llm.invoke(state["messages"])
-        return {"messages": [response]}
+        # Token counting runs tiktoken over the whole history; keep it off the loop
+        history = await asyncio.to_thread(trim_history, messages)
+        response = await rocky_chain.ainvoke({"messages": history})
     except Exception as exc:
         logger.error("Error in chatbot node: %s", str(exc), exc_info=True)
         raise RuntimeError(f"Error processing your request: {str(exc)}") from exc
 
+    # Answers built on tool output can go stale, and images only reach the
+    # user through the tool events, so only self-contained answers are shared
+    used_tools = any(isinstance(m, ToolMessage) for m in messages)
+    if question is not None and not used_tools and not response.tool_calls and response.content:
+        semantic_cache.store(question, response.content)
+
+    return {"messages": [response]}
+
 
 graph_builder.add_node("chatbot", chatbot)
 graph_builder.add_node("tools", ToolNode(tools=tools))
 graph_builder.add_conditional_edges("chatbot", tools_condition)
 graph_builder.add_edge("tools", "chatbot")
 graph_builder.set_entry_point("chatbot")
-graph = graph_builder.compile(checkpointer=MemorySaver())
+
+
+@lru_cache(maxsize=1)
+def get_graph():
+    """Return the compiled graph, built lazily inside the running event loop.
+
+    AsyncSqliteSaver binds to the loop it is created in, and opens its
+    aiosqlite connection on first use.
+    """
+    checkpointer = AsyncSqliteSaver(aiosqlite.connect(CHECKPOINT_DB_PATH))
+    return graph_builder.compile(checkpointer=checkpointer)
+
+
+async def close_graph() -> None:
+    """Close the checkpoint database; call once on application shutdown.
+
+    aiosqlite runs each connection on a non-daemon thread, so an open
+    connection keeps the interpreter from exiting.
+    """
+    if get_graph.cache_info().currsize:
+        await get_graph().checkpointer.conn.close()
+        get_graph.cache_clear()
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -395,6 +728,40 @@ def validate_input(user_input: str) -> tuple[bool, str]:
     return True, ""
 
 
+def stream_model_token(event: dict) -> str | None:
+    """Return streamed LLM text output."""
+    return event["data"]["chunk"].content
+
+
+def stream_cached_answer(event: dict) -> str | None:
+    """Return semantic-cache answers, which never reach the chat model."""
+    if event.get("name") != "chatbot":
+        return None
+    output = event["data"].get("output") or {}
+    for message in output.get("messages", []):
+        if message.response_metadata.get("semantic_cache"):
+            return message.content
+    return None
+
+
+def stream_tool_output(event: dict) -> str | None:
+    """Return tool outputs that are shown to the user (image markdown or links)."""
+    if event.get("name") != "find_geological_images":
+        return None
+    output = event["data"].get("output")
+    if hasattr(output, "content"):
+        output = output.content
+    output = str(output).strip()
+    return f"\n\n{output}\n\n" if output else None
+
+
+STREAM_EVENT_HANDLERS = {
+    "on_chat_model_stream": stream_model_token,
+    "on_chain_end": stream_cached_answer,
+    "on_tool_end": stream_tool_output,
+}
+
+
 async def run_agent(user_input: str, thread_id: str) -> AsyncGenerator[str, None]:
     """Stream generated tokens for the geology chatbot."""
     is_valid, error_msg = validate_input(user_input)
@@ -405,40 +772,21 @@ async def run_agent(user_input: str, thread_id: str) -> AsyncGenerator[str, None
 
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        state = graph.get_state(config)
-        is_new_conversation = not state.values.get("messages")
-
-        if is_new_conversation:
-            messages = [("system", SYSTEM_PROMPT), ("user", user_input)]
-        else:
-            messages = [("user", user_input)]
 
-        async for event in graph.astream_events(
-            {"messages": messages},
+        async for event in get_graph().astream_events(
+            {"messages": [HumanMessage(content=user_input)], "user_turns": 1},
             config=config,
             version="v2",
+            # Only model, tool and chatbot-node events are needed downstream
+            include_types=["chat_model", "tool"],
+            include_names=["chatbot"],
         ):
-            kind = event.get("event")
-
-            # Stream LLM text output
-            if kind == "on_chat_model_stream":
-                content = event["data"]["chunk"].content
-                if content:
-                    yield content
-            
-            # Handle tool outputs (especially images)
-            elif kind == "on_tool_end":
-                tool_name = event.get("name", "")
-                if tool_name == "find_geological_images":
-                    # Get the tool output
-                    output = event["data"].get("output")
-                    if hasattr(output, "content"):
-                        output = output.content
-                    output = str(output).strip()
-                    
-                    # Stream the tool output (which includes image markdown or links)
-                    if output:
-                        yield f"\n\n{output}\n\n"
+            handler = STREAM_EVENT_HANDLERS.get(event["event"])
+            if handler is None:
+                continue
+            text = handler(event)
+            if text:
+                yield text
 
     except Exception as exc:
         error_message = (
@@ -1,25 +1,50 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field, validator
+import os
 import uuid
-import json
 import asyncio
+import contextlib
+import inspect
 from datetime import datetime, timedelta
 from collections import defaultdict
+from collections.abc import AsyncIterator
 import logging
+import logging.handlers
+import queue
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+import orjson
+from cachetools import TTLCache
+from sse_starlette import EventSourceResponse
+
+# Configure logging: handlers write from a background thread so a slow
+# stdout pipe never stalls the event loop
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
 # Import your agent
-from agent import run_agent
+from agent import run_agent, close_graph, close_http_clients
+
+# The endpoints iterate run_agent with `async for`; a decorator that turns it
+# into a plain coroutine or a sync function would break streaming silently
+if not inspect.isasyncgenfunction(run_agent):
+    raise TypeError("agent.run_agent must be an async generator function")
 
 app = FastAPI(
     title="Geology Chat API",
     description="AI-powered geology assistant with expert knowledge",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -51,6 +76,274 @@ class RateLimiter:
 
 rate_limiter = RateLimiter(max_requests=20, window_seconds=60)
 
+def enforce_rate_limit(request: Request) -> str:
+    """Reject the request with 429 if its client is over the limit; return the client IP."""
+    client_ip = request.client.host
+    if not rate_limiter.is_allowed(client_ip):
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please try again later."
+        )
+    return client_ip
+
+# ═══════════════════════════════════════════════════════════════════════════
+# ADMISSION CONTROL
+# ═══════════════════════════════════════════════════════════════════════════
+
+class AdmissionController:
+    """
+    Bound the number of agent runs in flight across all clients.
+    
+    Callers past the limit wait their turn instead of being rejected. Unlike
+    a Semaphore, the limit can be changed at runtime with resize().
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self.active < self.limit)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify(1)
+
+    async def resize(self, limit: int) -> None:
+        async with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {"active": self.active, "waiting": self.waiting, "limit": self.limit}
+
+admission = AdmissionController(limit=int(os.getenv("MAX_CONCURRENT_STREAMS", "64")))
+
+# ═══════════════════════════════════════════════════════════════════════════
+# SSE ENCODING
+# ═══════════════════════════════════════════════════════════════════════════
+
+SSE_SEP = "\n"
+SSE_PING_SECONDS = 15
+
+SSE_DATA_PREFIX = b"data: "
+SSE_FRAME_END = b"\n\n"
+
+def sse_frame(data: bytes, event_id: int | None = None) -> bytes:
+    """Wrap already-encoded data as a Server-Sent Events data frame."""
+    frame = SSE_DATA_PREFIX + data + SSE_FRAME_END
+    if event_id is None:
+        return frame
+    return b"id: %d\n" % event_id + frame
+
+def sse_data(payload: dict, event_id: int | None = None) -> bytes:
+    """Encode a payload as a Server-Sent Events data frame."""
+    return sse_frame(orjson.dumps(payload), event_id)
+
+SSE_DONE_DATA = b"[DONE]"
+SSE_ERROR_DATA = orjson.dumps({"error": "An error occurred during response generation"})
+
+SSE_COALESCE_CHARS = 64
+SSE_COALESCE_SECONDS = 0.03
+
+async def coalesce(
+    chunks: AsyncIterator[str],
+    max_chars: int = SSE_COALESCE_CHARS,
+    max_delay: float = SSE_COALESCE_SECONDS,
+) -> AsyncIterator[list[str]]:
+    """
+    Group small text chunks so each SSE frame carries more than one token.
+    
+    Yields lists of consecutive chunks, flushed once they reach max_chars or
+    the oldest has waited max_delay seconds. The source is drained by a
+    single producer task so it always runs in one context, and a slow source
+    never holds back text that is already buffered.
+    """
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def produce():
+        try:
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    pending.put_nowait(chunk)
+        except Exception as exc:
+            pending.put_nowait(exc)
+        pending.put_nowait(end)
+
+    producer = asyncio.create_task(produce())
+    getter = None
+    buffer: list[str] = []
+    size = 0
+    deadline = 0.0
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(pending.get())
+            timeout = max(deadline - loop.time(), 0) if buffer else None
+            done, _ = await asyncio.wait((getter,), timeout=timeout)
+            if not done:
+                yield buffer
+                buffer, size = [], 0
+                continue
+
+            item, getter = getter.result(), None
+            if item is end or isinstance(item, Exception):
+                if buffer:
+                    yield buffer
+                if item is end:
+                    return
+                raise item
+
+            if not buffer:
+                deadline = loop.time() + max_delay
+            buffer.append(item)
+            size += len(item)
+            if size >= max_chars:
+                yield buffer
+                buffer, size = [], 0
+    finally:
+        if getter is not None:
+            getter.cancel()
+        producer.cancel()
+
+# ═══════════════════════════════════════════════════════════════════════════
+# RESUMABLE STREAMS
+# ═══════════════════════════════════════════════════════════════════════════
+
+STREAM_REPLAY_SECONDS = 300
+STREAM_REPLAY_MAX_THREADS = 1024
+STREAM_ABANDON_SECONDS = 30
+
+class ResumableStream:
+    """
+    Frames produced by one agent run, kept so a client that drops the
+    connection can reconnect with Last-Event-ID and pick up where it left
+    off instead of paying for a second run.
+    
+    Every frame carries its index in the stream as the SSE event id. If
+    every client goes away and none comes back within
+    STREAM_ABANDON_SECONDS, the run is cancelled so it stops spending tokens.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        self.frames: list[bytes] = []
+        self.last_id = -1
+        self.finished = False
+        self.task: asyncio.Task | None = None
+        self.subscribers = 0
+        self._abandon: asyncio.TimerHandle | None = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, payload: dict) -> None:
+        await self.publish_data(orjson.dumps(payload))
+
+    async def publish_data(self, data: bytes) -> None:
+        # Every frame, [DONE] included, carries an id so a client's
+        # Last-Event-ID says exactly how much of the run it has seen
+        async with self._changed:
+            self.last_id = len(self.frames)
+            self.frames.append(sse_frame(data, event_id=self.last_id))
+            self._changed.notify_all()
+
+    async def finish(self) -> None:
+        async with self._changed:
+            self.finished = True
+            self._changed.notify_all()
+
+    def resumes(self, message: str, last_event_id: int) -> bool:
+        """
+        Whether a request is a reconnect to this run rather than a new turn.
+        
+        Clients may keep sending Last-Event-ID after a reply has finished, so
+        a finished run is only replayed for the same message and only if the
+        client has not seen all of it yet.
+        """
+        if message != self.message:
+            return False
+        return not self.finished or last_event_id < self.last_id
+
+    async def subscribe(self, last_event_id: int = -1) -> AsyncIterator[bytes]:
+        """Yield every frame after last_event_id, following the run live until it ends."""
+        position = last_event_id + 1
+        self._attach()
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: position < len(self.frames) or self.finished
+                    )
+                    batch = self.frames[position:]
+                    finished = self.finished
+                position += len(batch)
+                for frame in batch:
+                    yield frame
+                if finished and not batch:
+                    return
+        finally:
+            self._detach()
+
+    def _attach(self) -> None:
+        self.subscribers += 1
+        if self._abandon is not None:
+            self._abandon.cancel()
+            self._abandon = None
+
+    def _detach(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers or self.finished or self.task is None:
+            return
+        self._abandon = asyncio.get_running_loop().call_later(
+            STREAM_ABANDON_SECONDS, self.task.cancel
+        )
+
+streams: TTLCache = TTLCache(maxsize=STREAM_REPLAY_MAX_THREADS, ttl=STREAM_REPLAY_SECONDS)
+
+async def produce_stream(stream: ResumableStream, message: str, thread_id: str) -> None:
+    """Run the agent and publish its reply to stream, independent of any one client."""
+    try:
+        # Send thread_id first
+        await stream.publish({"thread_id": thread_id})
+        
+        # Stream tokens with timeout protection
+        token_count = 0
+        async with admission:
+            async with contextlib.aclosing(coalesce(run_agent(message, thread_id))) as batches:
+                async for batch in batches:
+                    token_count += len(batch)
+                    await stream.publish({"content": "".join(batch)})
+                    
+                    # Prevent infinite loops
+                    if token_count > 50000:
+                        logger.warning(f"Token limit reached for thread {thread_id}")
+                        break
+        
+        # Signal completion
+        await stream.publish_data(SSE_DONE_DATA)
+        logger.info(f"Chat completed - Thread: {thread_id}, Tokens: {token_count}")
+        
+    except asyncio.CancelledError:
+        logger.info(f"Agent run abandoned by client - Thread: {thread_id}")
+        raise
+    except Exception:
+        logger.exception("Error in produce_stream() - Thread: %s", thread_id)
+        await stream.publish_data(SSE_ERROR_DATA)
+        await stream.publish_data(SSE_DONE_DATA)
+    finally:
+        await stream.finish()
+
 # ═══════════════════════════════════════════════════════════════════════════
 # MODELS
 # ═══════════════════════════════════════════════════════════════════════════
@@ -69,14 +362,39 @@ class ChatRequest(BaseModel):
 # MIDDLEWARE
 # ═══════════════════════════════════════════════════════════════════════════
 
+# Comma-separated origins, e.g. "https://rocky.example.com"; "*" allows any
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in (os.getenv("CORS_ALLOW_ORIGINS") or "*").split(",")
+    if origin.strip()
+]
+# The API uses no cookies or auth, so credentials are off unless asked for.
+# They are never allowed with "*": Starlette would echo any caller's Origin
+# back and accept credentialed requests from every site.
+CORS_ALLOW_CREDENTIALS = (
+    (os.getenv("CORS_ALLOW_CREDENTIALS") or "false").lower() == "true"
+    and "*" not in CORS_ALLOW_ORIGINS
+)
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, specify exact origins
-    allow_credentials=True,
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_credentials=CORS_ALLOW_CREDENTIALS,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # let browsers cache preflight responses for a day
 )
 
+# ═══════════════════════════════════════════════════════════════════════════
+# LIFECYCLE
+# ═══════════════════════════════════════════════════════════════════════════
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_clients()
+    await close_graph()
+    log_listener.stop()
+
 # ═══════════════════════════════════════════════════════════════════════════
 # ENDPOINTS
 # ═══════════════════════════════════════════════════════════════════════════
@@ -88,6 +406,7 @@ def read_root():
         "version": "1.0.0",
         "endpoints": {
             "chat": "/chat",
+            "chat_sync": "/chat/sync",
             "health": "/health"
         }
     }
@@ -96,7 +415,8 @@ def read_root():
 def health_check():
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "streams": admission.stats()
     }
 
 @app.post("/chat")
@@ -108,67 +428,69 @@ async def chat(req: ChatRequest, request: Request):
     - thread_id: Conversation identifier
     - content: Streamed response tokens
     - [DONE]: Stream completion signal
-    """
-    # Rate limiting
-    client_ip = request.client.host
-    if not rate_limiter.is_allowed(client_ip):
-        raise HTTPException(
-            status_code=429,
-            detail="Too many requests. Please try again later."
-        )
     
-    thread_id = req.thread_id or str(uuid.uuid4())
+    Every frame carries an SSE event id. Re-sending the request with the same
+    thread_id and a Last-Event-ID header replays the rest of the current
+    reply instead of running the agent again.
+    """
+    client_ip = enforce_rate_limit(request)
+    thread_id = req.thread_id or uuid.uuid4().hex
     
     logger.info(f"Chat request - Thread: {thread_id}, IP: {client_ip}")
     
-    try:
-        async def generate():
-            try:
-                # Send thread_id first
-                yield f"data: {json.dumps({'thread_id': thread_id})}\n\n"
-                
-                # Stream tokens with timeout protection
-                token_count = 0
-                async for chunk in run_agent(req.message, thread_id):
-                    token_count += 1
-                    yield f"data: {json.dumps({'content': chunk})}\n\n"
-                    
-                    # Prevent infinite loops
-                    if token_count > 50000:
-                        logger.warning(f"Token limit reached for thread {thread_id}")
-                        break
-                
-                # Signal completion
-                yield "data: [DONE]\n\n"
-                logger.info(f"Chat completed - Thread: {thread_id}, Tokens: {token_count}")
-                
-            except asyncio.CancelledError:
-                logger.info(f"Stream cancelled by client - Thread: {thread_id}")
-                raise
-            except Exception as e:
-                logger.error(f"Error in generate() - Thread: {thread_id}, Error: {str(e)}")
-                error_msg = f"data: {json.dumps({'error': 'An error occurred during response generation'})}\n\n"
-                yield error_msg
-                yield "data: [DONE]\n\n"
-        
-        return StreamingResponse(
-            generate(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no"  # Disable buffering in nginx
-            }
-        )
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error in chat endpoint - Thread: {thread_id}, Error: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail="Internal server error"
-        )
+    # A reconnecting client resumes the run it was following; anything
+    # else starts a new run
+    stream = None
+    position = -1
+    last_event_id = request.headers.get("last-event-id")
+    if req.thread_id and last_event_id is not None:
+        stream = streams.get(thread_id)
+        if last_event_id.isdecimal():
+            position = int(last_event_id)
+        if stream is not None and not stream.resumes(req.message, position):
+            stream = None
+    if stream is None:
+        stream = ResumableStream(req.message)
+        stream.task = asyncio.create_task(produce_stream(stream, req.message, thread_id))
+        streams[thread_id] = stream
+        position = -1
+    else:
+        logger.info(f"Resuming stream - Thread: {thread_id}, After event: {position}")
+    
+    async def generate():
+        try:
+            async for frame in stream.subscribe(position):
+                yield frame
+        except asyncio.CancelledError:
+            logger.info(f"Stream cancelled by client - Thread: {thread_id}")
+            raise
+    
+    # EventSourceResponse also sets Connection: keep-alive and
+    # X-Accel-Buffering: no, and pings idle streams so proxies keep them open
+    return EventSourceResponse(
+        generate(),
+        headers={"Cache-Control": "no-cache"},
+        ping=SSE_PING_SECONDS,
+        sep=SSE_SEP,
+    )
+
+@app.post("/chat/sync")
+async def chat_sync(req: ChatRequest, request: Request):
+    """
+    Answer a chat message in a single JSON body instead of an SSE stream.
+    
+    Returns:
+    - thread_id: Conversation identifier
+    - response: The full assistant reply
+    """
+    client_ip = enforce_rate_limit(request)
+    thread_id = req.thread_id or uuid.uuid4().hex
+    
+    logger.info(f"Sync chat request - Thread: {thread_id}, IP: {client_ip}")
+    
+    async with admission:
+        chunks = [chunk async for chunk in run_agent(req.message, thread_id)]
+    return {"thread_id": thread_id, "response": "".join(chunks)}
 
 # ═══════════════════════════════════════════════════════════════════════════
 # ERROR HANDLERS
@@ -177,11 +499,13 @@ async def chat(req: ChatRequest, request: Request):
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {str(exc)}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Internal server error"}
     )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop and httptools ship with uvicorn[standard]; naming them makes a
+    # missing dependency fail at startup instead of silently falling back
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# agent.py reads its configuration at import time
+_state_dir = tempfile.mkdtemp(prefix="geology-agent-tests-")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("TAVILY_API_KEY", "tvly-test")
+os.environ.setdefault("SEMANTIC_CACHE_DIR", os.path.join(_state_dir, "semantic_cache"))
+os.environ.setdefault("CHECKPOINT_DB_PATH", os.path.join(_state_dir, "checkpoints.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,134 @@
+import asyncio
+
+import httpx
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import agent
+
+
+class FakeSemanticCache:
+    def __init__(self):
+        self.stored = []
+
+    async def lookup(self, question):
+        return None
+
+    def store(self, question, answer):
+        self.stored.append((question, answer))
+
+
+class FakeChain:
+    def __init__(self, response):
+        self.response = response
+
+    async def ainvoke(self, inputs):
+        return self.response
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = FakeSemanticCache()
+    monkeypatch.setattr(agent, "semantic_cache", cache)
+    monkeypatch.setattr(agent, "trim_history", lambda messages: messages)
+    return cache
+
+
+def test_chatbot_caches_answer_without_tools(cache, monkeypatch):
+    monkeypatch.setattr(agent, "rocky_chain", FakeChain(AIMessage(content="Basalt is volcanic.")))
+
+    asyncio.run(
+        agent.chatbot({"messages": [HumanMessage(content="What is basalt?")], "user_turns": 1})
+    )
+
+    assert cache.stored == [("What is basalt?", "Basalt is volcanic.")]
+
+
+def test_chatbot_does_not_cache_answer_built_on_tools(cache, monkeypatch):
+    monkeypatch.setattr(agent, "rocky_chain", FakeChain(AIMessage(content="Here are images.")))
+    messages = [
+        HumanMessage(content="Show me basalt"),
+        AIMessage(
+            content="",
+            tool_calls=[{"name": "find_geological_images", "args": {"topic": "basalt"}, "id": "call-1"}],
+        ),
+        ToolMessage(content="![basalt](https://example.com/basalt.jpg)", tool_call_id="call-1"),
+    ]
+
+    asyncio.run(agent.chatbot({"messages": messages, "user_turns": 1}))
+
+    assert cache.stored == []
+
+
+def scrape(monkeypatch, content: bytes, content_type: str) -> str:
+    """Run web_scraper_tool against a canned response."""
+
+    def handler(request):
+        return httpx.Response(200, headers={"Content-Type": content_type}, content=content)
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(agent, "get_scraper_client", lambda: client)
+        async with client:
+            return await agent.web_scraper_tool.ainvoke({"url": "https://example.com/page"})
+
+    return asyncio.run(run())
+
+
+def test_scraper_uses_charset_from_content_type(monkeypatch):
+    page = "<html><body><p>Café basalt</p></body></html>".encode("utf-8")
+
+    text = scrape(monkeypatch, page, "text/html; charset=utf-8")
+
+    assert text == "Café basalt"
+
+
+def test_scraper_reports_byte_cap_before_any_text(monkeypatch):
+    page = b"<html><body><script>" + b"x" * 600_000 + b"</script><p>hi</p></body></html>"
+
+    text = scrape(monkeypatch, page, "text/html; charset=utf-8")
+
+    assert text == agent.SCRAPER_BYTE_CAP_NO_TEXT
+
+
+def long_turn(number: int, tool_rounds: int) -> list:
+    """A user turn followed by tool_rounds tool calls and a final answer."""
+    messages = [HumanMessage(content=f"question {number}", id=f"h{number}")]
+    for round_ in range(tool_rounds):
+        call_id = f"call-{number}-{round_}"
+        messages.append(
+            AIMessage(
+                content="",
+                tool_calls=[{"name": "tavily_search", "args": {"query": "x"}, "id": call_id}],
+                id=f"a{number}-{round_}",
+            )
+        )
+        messages.append(ToolMessage(content="result", tool_call_id=call_id, id=f"t{number}-{round_}"))
+    messages.append(AIMessage(content=f"answer {number}", id=f"a{number}"))
+    return messages
+
+
+def test_bounded_reducer_keeps_previous_turn_after_long_turn():
+    history = long_turn(1, tool_rounds=30)  # 62 messages, over the cap on its own
+    question = HumanMessage(content="and the second one?", id="h2")
+
+    kept = agent.add_messages_bounded(history, [question])
+
+    assert kept[0].content == "question 1"
+    assert kept[-1].content == "and the second one?"
+
+
+def test_bounded_reducer_drops_whole_old_turns():
+    history = long_turn(1, tool_rounds=15) + long_turn(2, tool_rounds=5)
+
+    kept = agent.add_messages_bounded(history, [HumanMessage(content="next", id="h3")])
+
+    assert len(kept) <= agent.HISTORY_MAX_MESSAGES
+    assert kept[0].content == "question 2"
+
+
+def test_follow_up_is_not_standalone_even_if_trimmed_to_one_question():
+    state = {"messages": [HumanMessage(content="and the second one?")], "user_turns": 2}
+
+    assert agent.standalone_question(state) is None
+    assert agent.standalone_question({**state, "user_turns": 1}) == "and the second one?"
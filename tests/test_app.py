@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as app_module
+
+
+@pytest.fixture
+def agent_calls(monkeypatch):
+    """Replace run_agent with a canned reply and record each call."""
+    calls = []
+
+    async def fake_run_agent(user_input, thread_id):
+        calls.append(user_input)
+        yield f"reply to {user_input}"
+
+    monkeypatch.setattr(app_module, "run_agent", fake_run_agent)
+    app_module.streams.clear()
+    return calls
+
+
+@pytest.fixture
+def client():
+    return TestClient(app_module.app)
+
+
+def test_finished_stream_runs_new_message(agent_calls, client):
+    first = client.post("/chat", json={"message": "what is basalt?", "thread_id": "t1"})
+    assert "reply to what is basalt?" in first.text
+
+    # Clients may keep sending the last id they saw on every later turn
+    second = client.post(
+        "/chat",
+        json={"message": "and granite?", "thread_id": "t1"},
+        headers={"Last-Event-ID": "1"},
+    )
+
+    assert agent_calls == ["what is basalt?", "and granite?"]
+    assert "reply to and granite?" in second.text
+    assert second.text.endswith("data: [DONE]\n\n")
+
+
+def test_reconnect_replays_missed_frames(agent_calls, client):
+    client.post("/chat", json={"message": "what is basalt?", "thread_id": "t1"})
+
+    resumed = client.post(
+        "/chat",
+        json={"message": "what is basalt?", "thread_id": "t1"},
+        headers={"Last-Event-ID": "0"},
+    )
+
+    assert agent_calls == ["what is basalt?"]
+    assert resumed.text.startswith("id: 1\n")
+    assert "reply to what is basalt?" in resumed.text
+
+
+def test_reconnect_after_missing_done_does_not_rerun_agent(agent_calls, client):
+    first = client.post("/chat", json={"message": "what is basalt?", "thread_id": "t1"})
+    # The client saw every content frame (ids 0 and 1) but lost [DONE]
+    assert first.text.endswith("id: 2\ndata: [DONE]\n\n")
+
+    resumed = client.post(
+        "/chat",
+        json={"message": "what is basalt?", "thread_id": "t1"},
+        headers={"Last-Event-ID": "1"},
+    )
+
+    assert agent_calls == ["what is basalt?"]
+    assert resumed.text == "id: 2\ndata: [DONE]\n\n"
+
+
+def test_same_message_after_full_reply_starts_new_run(agent_calls, client):
+    client.post("/chat", json={"message": "tell me more", "thread_id": "t1"})
+
+    client.post(
+        "/chat",
+        json={"message": "tell me more", "thread_id": "t1"},
+        headers={"Last-Event-ID": "2"},
+    )
+
+    assert agent_calls == ["tell me more", "tell me more"]
+
+
+def test_non_decimal_last_event_id_replays_from_start(agent_calls, client):
+    client.post("/chat", json={"message": "what is basalt?", "thread_id": "t1"})
+
+    response = client.post(
+        "/chat",
+        json={"message": "what is basalt?", "thread_id": "t1"},
+        headers=[(b"last-event-id", "²".encode("latin-1"))],
+    )
+
+    assert response.status_code == 200
+    assert response.text.startswith("id: 0\n")
+    assert agent_calls == ["what is basalt?"]
+
+
+def test_coalesce_groups_every_chunk():
+    async def chunks():
+        for index in range(50):
+            yield f"t{index} "
+
+    async def collect():
+        return [batch async for batch in app_module.coalesce(chunks())]
+
+    batches = asyncio.run(collect())
+
+    # Every token is counted once, in order, and frames carry several each
+    assert sum(len(batch) for batch in batches) == 50
+    assert "".join("".join(batch) for batch in batches) == "".join(
+        f"t{index} " for index in range(50)
+    )
+    assert len(batches) < 50
+
+
+def test_wildcard_cors_does_not_allow_credentials(client):
+    response = client.options(
+        "/chat",
+        headers={"Origin": "https://evil.example", "Access-Control-Request-Method": "POST"},
+    )
+
+    assert response.headers["access-control-allow-origin"] == "*"
+    assert "access-control-allow-credentials" not in response.headers